@@ -4,6 +4,22 @@ import os
 import sys
 import SocketServer
 import argparse
+import threading
+import Queue
+import signal
+import socket
+import random
+import collections
+import hashlib
+import json
+import struct
+import zlib
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 def getfiles(path):
     items = os.listdir(path)
@@ -11,6 +27,285 @@ def getfiles(path):
     files = filter(os.path.isfile, fullitems)
     return map(os.path.basename, files)
 
+class PhotoIndex(object):
+    """
+    Resident set of the files in the photo directory.
+
+    Kept current from inotify events when pyinotify is installed. Otherwise
+    refresh() costs one stat of the directory and only rescans it when its
+    mtime has moved.
+
+    Every add and delete bumps a generation counter and goes into a bounded
+    change log, so clients can ask for what changed since the generation
+    they last saw. The epoch is new for every server start, generations
+    from an older epoch are meaningless.
+    """
+    def __init__(self, path, use_inotify=True, changelog_size=10000):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = set()
+        self.dir_mtime = None
+        self.notifier = None
+        self.epoch = "%08x" % random.getrandbits(32)
+        self.generation = 0
+        self.changelog = collections.deque(maxlen=changelog_size)  # (generation, "+" or "-", name)
+        if use_inotify and pyinotify is not None:
+            self.start_watch()
+        self.rescan()
+
+    def start_watch(self):
+        index = self
+
+        class EventHandler(pyinotify.ProcessEvent):
+            def process_IN_CREATE(self, event):
+                if not event.dir:
+                    index.add(event.name)
+
+            def process_IN_MOVED_TO(self, event):
+                if not event.dir:
+                    index.add(event.name)
+
+            def process_IN_DELETE(self, event):
+                index.discard(event.name)
+
+            def process_IN_MOVED_FROM(self, event):
+                index.discard(event.name)
+
+            def process_IN_Q_OVERFLOW(self, event):
+                print "inotify queue overflow, rescanning %s" % index.path
+                index.rescan()
+
+        wm = pyinotify.WatchManager()
+        mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+            pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM
+        self.notifier = pyinotify.ThreadedNotifier(wm, EventHandler())
+        self.notifier.daemon = True
+        self.notifier.start()
+        wm.add_watch(self.path, mask)
+        print "watching %s with inotify" % self.path
+
+    def stop(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+
+    def rescan(self):
+        # stat first so a change made during the listdir is caught next time
+        mtime = os.stat(self.path).st_mtime
+        files = set(getfiles(self.path))
+        with self.lock:
+            if self.dir_mtime is not None:  # initial scan is generation 0
+                for f in self.files - files:
+                    self._record("-", f)
+                for f in files - self.files:
+                    self._record("+", f)
+            self.files = files
+            self.dir_mtime = mtime
+        print "indexed %d files in %s" % (len(files), self.path)
+
+    def refresh(self):
+        if self.notifier is not None:
+            return
+        if os.stat(self.path).st_mtime != self.dir_mtime:
+            self.rescan()
+
+    def _record(self, op, name):
+        # caller holds self.lock
+        self.generation += 1
+        self.changelog.append((self.generation, op, name))
+
+    def add(self, name):
+        with self.lock:
+            if name not in self.files:
+                self.files.add(name)
+                self._record("+", name)
+
+    def discard(self, name):
+        with self.lock:
+            if name in self.files:
+                self.files.discard(name)
+                self._record("-", name)
+
+    def list(self):
+        self.refresh()
+        with self.lock:
+            return list(self.files)
+
+    def snapshot(self):
+        """
+        @return (epoch, generation, [] files)
+        """
+        self.refresh()
+        with self.lock:
+            return self.epoch, self.generation, list(self.files)
+
+    def changes_since(self, epoch, generation):
+        """
+        @return (generation, [] of (op, name)) or None if the change log no
+                longer reaches back to the given generation
+        """
+        self.refresh()
+        with self.lock:
+            if epoch != self.epoch or generation > self.generation:
+                return None
+            if generation == self.generation:
+                return self.generation, []
+            if not self.changelog or self.changelog[0][0] > generation + 1:
+                return None  # truncated
+            return self.generation, [(op, name) for g, op, name in self.changelog if g > generation]
+
+class DigestCache(object):
+    """
+    md5 of each photo, persisted to a json file and keyed by
+    (inode, size, mtime) so a file is only read again after it changed
+    """
+    def __init__(self, path, filename):
+        self.path = path
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.entries = {}  # key = name, value = [inode, size, mtime, digest]
+        try:
+            with open(filename, "rb") as fp:
+                # json gives unicode names, the index has byte strings
+                self.entries = dict((k.encode("utf-8"), v) for k, v in json.load(fp).iteritems())
+            print "loaded %d digests from %s" % (len(self.entries), filename)
+        except (IOError, ValueError):
+            pass
+
+    def get(self, name):
+        """
+        @return (size, mtime, digest) or None if the file is gone
+        """
+        try:
+            st = os.stat(os.path.join(self.path, name))
+        except OSError:
+            return None
+        key = [st.st_ino, st.st_size, st.st_mtime]
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is None or entry[:3] != key:
+            h = hashlib.md5()
+            try:
+                with open(os.path.join(self.path, name), "rb") as fp:
+                    for chunk in iter(lambda: fp.read(65536), ""):
+                        h.update(chunk)
+            except IOError:
+                return None
+            entry = key + [h.hexdigest()]
+            with self.lock:
+                self.entries[name] = entry
+                self.dirty = True
+        return entry[1], entry[2], entry[3]
+
+    def save(self, names):
+        """
+        write the cache back if it changed, dropping files no longer in names
+        """
+        # held across the write so concurrent saves don't share the tmp file
+        with self.lock:
+            for name in set(self.entries) - set(names):
+                del self.entries[name]
+                self.dirty = True
+            if not self.dirty:
+                return
+            tmpname = self.filename + ".tmp"
+            with open(tmpname, "wb") as fp:
+                json.dump(self.entries, fp)
+            os.rename(tmpname, self.filename)
+            self.dirty = False
+
+PROTOCOL_VERSION = 2
+COMPRESS_MIN_SIZE = 4096  # smaller payloads are not worth deflating
+MAX_FRAME_SIZE = 1 << 20  # commands and manifest rows are tiny, anything bigger is garbage
+FLAG_ZLIB = 1
+
+def encode_frame(fields, compress=False):
+    """
+    frame = 1 byte flags, 4 byte payload length, payload
+    payload = for each field: 4 byte length, field bytes
+    """
+    payload = "".join(struct.pack(">I", len(f)) + f for f in fields)
+    flags = 0
+    if compress and len(payload) >= COMPRESS_MIN_SIZE:
+        payload = zlib.compress(payload)
+        flags |= FLAG_ZLIB
+    return struct.pack(">BI", flags, len(payload)) + payload
+
+def read_frame(rfile):
+    """
+    @return [] fields of the next frame, None at EOF or on a frame, or its
+            inflated payload, over MAX_FRAME_SIZE
+    """
+    header = rfile.read(5)
+    if len(header) < 5:
+        return None
+    flags, length = struct.unpack(">BI", header)
+    if length > MAX_FRAME_SIZE:
+        print "dropping session on a %d byte frame" % length
+        return None
+    payload = rfile.read(length)
+    if len(payload) < length:
+        return None
+    if flags & FLAG_ZLIB:
+        inflate = zlib.decompressobj()
+        try:
+            payload = inflate.decompress(payload, MAX_FRAME_SIZE)
+        except zlib.error:
+            print "dropping session on a corrupt frame"
+            return None
+        if inflate.unconsumed_tail:
+            print "dropping session on a frame inflating past %d bytes" % MAX_FRAME_SIZE
+            return None
+    fields = []
+    pos = 0
+    while pos < len(payload):
+        n, = struct.unpack_from(">I", payload, pos)
+        fields.append(payload[pos + 4:pos + 4 + n])
+        pos += 4 + n
+    return fields
+
+g_receiving = set()  # names with a put in progress
+g_receiving_lock = threading.Lock()
+
+def incoming_dir(path):
+    """
+    server state lives in this hidden subdirectory, out of sight of list,
+    the slideshow and the non-recursive inotify watch
+    """
+    incoming = os.path.join(path, ".incoming")
+    if not os.path.isdir(incoming):
+        try:
+            os.mkdir(incoming)
+        except OSError:  # created by a concurrent put
+            pass
+    return incoming
+
+def partial_filename(name, size):
+    """
+    uploads are staged here until complete, keyed by size so a retry only
+    resumes a transfer of the same file
+    """
+    return os.path.join(incoming_dir(options.path), "%s.%d.part" % (name, size))
+
+def expire_partials(path, max_age):
+    """
+    remove partial uploads not resumed within max_age seconds, the client
+    gave up on them or the photo was dropped from the sync since
+    """
+    incoming = incoming_dir(path)
+    cutoff = time.time() - max_age
+    cnt = 0
+    for f in os.listdir(incoming):
+        fullname = os.path.join(incoming, f)
+        try:
+            if f.endswith(".part") and os.path.getmtime(fullname) < cutoff:
+                os.remove(fullname)
+                cnt += 1
+        except OSError:  # resumed or removed meanwhile
+            pass
+    if cnt:
+        print "removed %d stale partial uploads" % cnt
+
 class SimpleServer(SocketServer.TCPServer):
     # By setting this we allow the server to re-bind to the address by
     # setting SO_REUSEADDR, meaning you don't have to wait for
@@ -18,6 +313,50 @@ class SimpleServer(SocketServer.TCPServer):
     # closed down correctly.
     allow_reuse_address = True
 
+class ThreadPoolMixIn(SocketServer.ThreadingMixIn):
+    """
+    Handle connections on a fixed pool of worker threads instead of
+    SocketServer.ThreadingMixIn's one new thread per connection.
+
+    Accepted connections wait in a bounded queue; when it is full the
+    accept loop blocks until a worker frees up.
+    """
+    num_workers = 4
+    max_pending = 16
+
+    def start_workers(self):
+        self.pending = Queue.Queue(self.max_pending)
+        self.workers = []
+        for i in range(self.num_workers):
+            t = threading.Thread(target=self.worker, name="worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def worker(self):
+        while True:
+            item = self.pending.get()
+            if item is None:  # drain sentinel
+                break
+            request, client_address = item
+            # finish_request + shutdown_request, errors go to handle_error
+            self.process_request_thread(request, client_address)
+
+    def process_request(self, request, client_address):
+        self.pending.put((request, client_address))
+
+    def drain(self):
+        """
+        let the workers finish everything already accepted, then stop them
+        """
+        for t in self.workers:
+            self.pending.put(None)
+        for t in self.workers:
+            t.join()
+
+class ThreadPoolServer(ThreadPoolMixIn, SimpleServer):
+    pass
+
 class MyTCPHandler(SocketServer.StreamRequestHandler):
     """
     The RequestHandler class for our server.
@@ -30,59 +369,289 @@ class MyTCPHandler(SocketServer.StreamRequestHandler):
     #     # self.data = ""
     #     SocketServer.StreamRequestHandler.__init__(self, *args, **kwargs)
 
+    binary = False  # length-prefixed frames instead of text lines
+    compress = False  # client accepts zlib compressed frames
+
     def handle_single(self, cmd):
         print "got command: '%s'" % cmd
-        if cmd == "list":
-            print "loading files from %s" % options.path
-            files = getfiles(options.path)
-            return "\t".join(files)
-        elif cmd.startswith("del\t"):
+        return "\t".join(self.handle_fields(cmd.split("\t")))
+
+    def handle_fields(self, fields):
+        """
+        run one command
+        @param [] fields command name followed by its arguments
+        @return [] reply fields, sent tab-joined on one line in text mode
+        """
+        cmd, args = fields[0], fields[1:]
+        if cmd == "list" and not args:
+            files = index.list()
+            print "listing %d files from %s" % (len(files), options.path)
+            return files
+        elif cmd == "list" and args == ["meta"]:
+            # -> meta, <name>, <size>, <mtime>, <digest>, <name>... for every
+            # file. the leading meta tells it apart from older servers, which
+            # ignore the argument and send a plain list
+            files = index.list()
+            print "listing %d files with digests from %s" % (len(files), options.path)
+            reply = ["meta"]
+            for name in files:
+                meta = digests.get(name)
+                if meta is not None:
+                    reply += [name, str(meta[0]), repr(meta[1]), meta[2]]
+            digests.save(files)
+            return reply
+        elif cmd == "changes":
+            # changes[, <epoch>, <generation>]
+            #   -> delta, <epoch>, <generation>, +added, -deleted...
+            #   -> full, <epoch>, <generation>, file1, file2...
+            delta = None
+            if len(args) == 2 and args[1].isdigit():
+                delta = index.changes_since(args[0], int(args[1]))
+            if delta is not None:
+                generation, changes = delta
+                print "%d changes since generation %s" % (len(changes), args[1])
+                return ["delta", index.epoch, str(generation)] + \
+                    map(lambda c: c[0] + c[1], changes)
+            epoch, generation, files = index.snapshot()
+            print "full listing of %d files at generation %d" % (len(files), generation)
+            return ["full", epoch, str(generation)] + files
+        elif cmd == "del":
             print "deleting files from %s" % options.path
-            print "====>", cmd
-            cnt = 0
-            split = cmd.split("\t")[1:]
-            for f in split:
-                print "deleting file %s" % f
-                fullname = os.path.join(options.path, f)
-                if os.path.isfile(fullname):
+            print "====>", args
+            return [str(self.delete_files(args))]
+        elif cmd == "sync":
+            # sync, <count> followed by <count> manifest rows of
+            # <name>, <size>[, <digest>], the set of files the client wants
+            # on the frame. deletes everything else.
+            #   -> <number deleted>, <name to upload>, <name to upload>...
+            if len(args) != 1 or not args[0].isdigit():
+                return ["error", "usage: sync <count>"]
+            manifest = {}
+            bad_rows = 0
+            for i in range(int(args[0])):
+                row = self.read_row()
+                if row is None:
+                    return ["error", "manifest ended after %d rows" % i]
+                # keep reading past bad rows so the session stays in sync
+                if len(row) < 2 or not row[1].isdigit():
+                    bad_rows += 1
+                    continue
+                digest = row[2] if len(row) > 2 else None
+                manifest[os.path.basename(row[0])] = (int(row[1]), digest)
+            if bad_rows:
+                # never delete anything on a manifest we couldn't fully read
+                return ["error", "%d malformed manifest rows" % bad_rows]
+            print "syncing to a manifest of %d files" % len(manifest)
+            deleted = self.delete_files(set(index.list()) - set(manifest))
+            needed = []
+            for name, (size, digest) in sorted(manifest.iteritems()):
+                fullname = os.path.join(options.path, name)
+                try:
+                    if os.path.getsize(fullname) != size:
+                        needed.append(name)
+                    elif digest is not None and digests.get(name)[2] != digest:
+                        needed.append(name)  # same name and size, different content
+                except (OSError, TypeError):  # not on the frame
+                    needed.append(name)
+            digests.save(index.list())
+            print "%d files deleted, %d files needed" % (deleted, len(needed))
+            return [str(deleted)] + needed
+        elif cmd == "offset":
+            # offset, <name>, <size> -> bytes already received of that upload
+            if len(args) != 2 or not args[1].isdigit():
+                return ["error", "usage: offset <name> <size>"]
+            partname = partial_filename(os.path.basename(args[0]), int(args[1]))
+            if os.path.isfile(partname):
+                return [str(os.path.getsize(partname))]
+            return ["0"]
+        elif cmd == "put":
+            # put, <name>, <size>[, <offset>] followed by <size> - <offset>
+            # raw bytes of file content
+            if len(args) not in (2, 3) or not all(a.isdigit() for a in args[1:]):
+                # the body length is unknown, so the session can't recover
+                # from here, but the client gets told why
+                return ["error", "usage: put <name> <size> [<offset>]"]
+            offset = int(args[2]) if len(args) > 2 else 0
+            return self.receive_file(args[0], int(args[1]), offset)
+        else:
+            return []
+
+    def read_row(self):
+        """
+        @return [] fields of the next line or frame, None at EOF
+        """
+        if self.binary:
+            return read_frame(self.rfile)
+        data = self.rfile.readline()
+        if not data:
+            return None
+        return data.rstrip("\r\n").split("\t")
+
+    def send_row(self, fields):
+        if self.binary:
+            self.request.sendall(encode_frame(fields, self.compress))
+        else:
+            self.request.sendall("\t".join(fields) + "\n")
+
+    def delete_files(self, names):
+        cnt = 0
+        for f in names:
+            print "deleting file %s" % f
+            fullname = os.path.join(options.path, f)
+            if os.path.isfile(fullname):
+                try:
                     os.remove(fullname)
+                    index.discard(f)
                     cnt += 1
-                else:
-                    print "not a file %s" % fullname
-            return str(cnt)
-        else:
-            return ""
+                except OSError:  # deleted by a concurrent request
+                    print "could not delete %s" % fullname
+            else:
+                print "not a file %s" % fullname
+        return cnt
+
+    def receive_file(self, name, size, offset):
+        """
+        append the file body to its partial file under --path/.incoming,
+        then fsync and rename it into --path so the slideshow and list never
+        see a truncated photo. if the connection drops, what was received
+        stays in the partial file and a later put resumes from its size.
+        """
+        name = os.path.basename(name)
+        partname = partial_filename(name, size)
+        remaining = size - offset
+
+        with g_receiving_lock:
+            busy = name in g_receiving
+            g_receiving.add(name)
+        try:
+            valid = name and not name.startswith(".") and not busy and \
+                0 <= offset <= size and \
+                (offset == 0 or (os.path.isfile(partname) and os.path.getsize(partname) >= offset))
+            if not valid:
+                # consume the body anyway so the session stays in sync
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 65536))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                return ["error", "can't put '%s' at offset %d" % (name, offset)]
+
+            print "receiving file %s (%d of %d bytes)" % (name, remaining, size)
+            with open(partname, "r+b" if offset else "wb") as fp:
+                fp.seek(offset)
+                fp.truncate()
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 65536))
+                    if not chunk:
+                        raise IOError("connection closed with %d of %d bytes left" % (remaining, size))
+                    fp.write(chunk)
+                    remaining -= len(chunk)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.rename(partname, os.path.join(options.path, name))
+        finally:
+            if not busy:
+                with g_receiving_lock:
+                    g_receiving.discard(name)
+        index.add(name)
+        return ["ok"]
 
     def handle(self):
         # self.request is the TCP socket connected to the client
-        data = self.rfile.readline()
+        try:
+            data = self.rfile.readline()
+        except socket.timeout:
+            print "{} timed out".format(self.client_address[0])
+            return
         print "{} wrote:".format(self.client_address[0])
 
-        return_string = self.handle_single(data.strip())
-        self.request.sendall(return_string + "\n")
+        split = data.strip().split("\t")
+        if split[0] != "session":
+            # single command per connection, the reply ends at EOF
+            return_string = self.handle_single(data.strip())
+            self.request.sendall(return_string + "\n")
+            return
 
-        # self.data += data
-        # cmd_split = self.data.split("\n")
-
-        # self.data = cmd_split[-1]
-        # cmd_split = cmd_split[:-1]
-
-        # for cmd in cmd_split:
-        #     return_string = self.handle_single(cmd)
-        #     self.request.sendall(return_string + "\n")
+        # keep-alive session: answer each command in order until the client
+        # closes its end, so commands can be pipelined.
+        # session[, <version>[, zlib]] picks the framing: version 1 is tab
+        # separated lines, version 2 is length-prefixed frames.
+        version = PROTOCOL_VERSION if len(split) > 1 and split[1].isdigit() and \
+            int(split[1]) >= PROTOCOL_VERSION else 1
+        if version == 1:
+            self.request.sendall("ok\n")
+        else:
+            self.request.sendall("ok\t%d\n" % version)
+            self.binary = True
+            self.compress = "zlib" in split[2:]
+        while True:
+            try:
+                fields = self.read_row()
+            except socket.timeout:
+                print "{} session timed out".format(self.client_address[0])
+                break
+            if fields is None:
+                break
+            print "got command: %s" % fields[0]
+            self.send_row(self.handle_fields(fields))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='server')
     parser.add_argument("--port", type=int, default=9999)
     parser.add_argument("--path", type=str, default=".")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="number of connections handled concurrently, 0 to handle them serially")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="seconds to wait on a silent client before dropping it")
+    parser.add_argument("--poll", action="store_true",
+                        help="don't use inotify, rescan --path whenever its mtime changes")
+    parser.add_argument("--changelog", type=int, default=10000,
+                        help="number of adds/deletes kept for the changes command")
+    parser.add_argument("--digest-cache", type=str, default=None,
+                        help="file to keep photo digests in, default --path/.incoming/digests.json")
+    parser.add_argument("--part-max-age", type=float, default=7,
+                        help="days to keep an interrupted upload for resuming, cleared at start up")
     options = parser.parse_args()
 
+    expire_partials(options.path, options.part_max_age * 24 * 3600)
+
+    digests = DigestCache(options.path, options.digest_cache or
+                          os.path.join(incoming_dir(options.path), "digests.json"))
+
+    index = PhotoIndex(options.path, use_inotify=not options.poll,
+                       changelog_size=options.changelog)
+
     HOST, PORT = "", options.port
 
+    # applied to each connection's socket in StreamRequestHandler.setup()
+    MyTCPHandler.timeout = options.timeout if options.timeout > 0 else None
+
     # Create the server, binding to localhost on port 9999
-    server = SimpleServer((HOST, PORT), MyTCPHandler)
+    if options.workers > 0:
+        ThreadPoolServer.num_workers = options.workers
+        ThreadPoolServer.max_pending = options.workers * 4
+        server = ThreadPoolServer((HOST, PORT), MyTCPHandler)
+        server.start_workers()
+    else:
+        server = SimpleServer((HOST, PORT), MyTCPHandler)
+
+    # shutdown() blocks until serve_forever() returns, so it can't be
+    # called from the signal handler running on the serving thread
+    def on_sigterm(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, on_sigterm)
 
     # Activate the server; this will keep running until you
     # interrupt the program with Ctrl-C
-    server.serve_forever()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    # finish the connections that were already accepted
+    print "shutting down"
+    if options.workers > 0:
+        server.drain()
+    server.server_close()
+    index.stop()
 
@@ -1,3 +1,4 @@
+import heapq
 import time
 import zlib
 
@@ -33,15 +34,17 @@ def run(params, path, dirs, files, logger=None):
             # print "t", t, (t - last) if last else ""
             # last = t
 
-            hash_fname_l = []
             hashorig = t  # different every interval
-            for e in files:
-                h = zlib.crc32(str(hashorig) + e)
-                hash_fname_l.append((h, e))
-            hash_fname_l.sort()
+            # crc32(prefix + e) continued from the crc of the prefix, and the
+            # photos_per_slice smallest (h, e) kept in a bounded heap, same
+            # picks as sorting everything: O(n log k) instead of O(n log n)
+            crc_prefix = zlib.crc32(str(hashorig))
+            hash_fname_l = heapq.nsmallest(
+                photos_per_slice,
+                ((zlib.crc32(e, crc_prefix), e) for e in files))
             # for e in hash_fname_l:
             #     print e
-            tmp_files |= set(zip(*(hash_fname_l[:photos_per_slice]))[1])
+            tmp_files |= set(e for h, e in hash_fname_l)
         # files = set(zip(*(hash_fname_l[:hash_x]))[1])
         files = tmp_files
 
@@ -1,25 +1,105 @@
 import ConfigParser
+import cPickle
 import os
+import tempfile
 
-g_path_config_map = {}  # key = path, value = parsed picasa config
+g_path_record_map = None  # key = path, value = ((ini mtime, ini size), starred names, suppressed count)
+g_dirty = False
+g_seen = set()  # directories looked at this run, the rest is dropped on save
+g_cache_path = tempfile.gettempdir()
 
-def _getconfig(path):
+def set_cache_path(path):
     """
-    @param string path
-    @returns config object or None
+    directory to keep the record cache in, set from the scan_cache_path param
+    """
+    global g_cache_path, g_path_record_map, g_dirty
+    if path != g_cache_path:
+        g_cache_path = path
+        g_path_record_map = None  # load again from the new place
+        g_dirty = False
+
+def _cache_filename():
+    return os.path.join(g_cache_path, "filter_picasa_cache.pickle")
+
+def _getcache():
+    global g_path_record_map
+    if g_path_record_map is None:
+        try:
+            with open(_cache_filename(), "rb") as fp:
+                g_path_record_map = cPickle.load(fp)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            g_path_record_map = {}
+    return g_path_record_map
+
+def save_cache():
+    """
+    persist the parsed .picasa.ini records for the next run, dropping
+    albums that were moved or left out of the sync
     """
-    if path in g_path_config_map:
-        return g_path_config_map[path]
+    global g_dirty
+    if g_path_record_map is None and not g_seen:
+        return
+    cache = _getcache()  # not loaded yet when every directory was a scan cache hit
+    for path in set(cache) - g_seen:
+        del cache[path]
+        g_dirty = True
+    if not g_dirty:
+        return
+    with open(_cache_filename(), "wb") as fp:
+        cPickle.dump(g_path_record_map, fp, cPickle.HIGHEST_PROTOCOL)
+    g_dirty = False
 
+def _getrecord(path, logger=None):
+    """
+    @param string path
+    @returns (frozenset of starred lowercase names, int suppressed count)
+             or None if there is no .picasa.ini. the ini is only parsed
+             again when its mtime or size changed.
+    """
+    global g_dirty
+    g_seen.add(path)
     picasa_ini = os.path.join(path, '.picasa.ini')
-    if not os.path.isfile(picasa_ini):
-        g_path_config_map[path] = None
+    try:
+        st = os.stat(picasa_ini)
+    except OSError:
         return None
 
+    key = (st.st_mtime, st.st_size)
+    cache = _getcache()
+    record = cache.get(path)
+    if record is not None and record[0] == key:
+        return record[1], record[2]
+
     config = ConfigParser.ConfigParser()
     config.read(picasa_ini)
-    g_path_config_map[path] = config
-    return config
+
+    star_files = set()
+    cnt_suppressed = 0
+    for s in config.sections():
+        items = config.items(s)
+        if logger: logger.debug("%s %s" % (s, items))
+        if ('suppress', 'yes') in items:  # "Block from Uploading" flag in picasa
+            cnt_suppressed += 1
+            continue
+        if ('star', 'yes') in items:
+            star_files.add(s.lower())
+
+    record = (key, frozenset(star_files), cnt_suppressed)
+    cache[path] = record
+    g_dirty = True
+    return record[1], record[2]
+
+def cache_key(params, path):
+    """
+    @param string path
+    @return state of the .picasa.ini that run() depends on, for the scan cache
+    """
+    g_seen.add(path)  # run() is skipped on a scan cache hit, keep its record
+    try:
+        st = os.stat(os.path.join(path, '.picasa.ini'))
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
 
 def run(params, path, dirs, files, logger=None):
     """
@@ -28,21 +108,11 @@ def run(params, path, dirs, files, logger=None):
     @param [] files
     @return (dirs, files)
     """
-    picasa_ini = os.path.join(path, '.picasa.ini')
-    config = _getconfig(path)
-    if config is None:
+    record = _getrecord(path, logger)
+    if record is None:
         return dirs, []
 
-    star_files = set()
-    cnt_suppressed = 0
-    for s in config.sections():
-        if logger: logger.debug("%s %s %s" % (s, config.items(s), ('suppress', 'yes') in config.items(s)))
-        if ('suppress', 'yes') in config.items(s):  # "Block from Uploading" flag in picasa
-            cnt_suppressed += 1
-            continue
-        if logger: logger.debug("%s %s %s" % (s, config.items(s), ('star', 'yes') in config.items(s)))
-        if ('star', 'yes') in config.items(s):
-            star_files.add(s.lower())
+    star_files, cnt_suppressed = record
     # meta["pre_starred_filter"] = len(files)
     files = filter(lambda e: os.path.basename(e).lower() in star_files, files)
     if logger and (len(files) > 0 or cnt_suppressed > 0):
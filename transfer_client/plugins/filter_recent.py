@@ -1,5 +1,12 @@
+import heapq
 import os
 
+def _getmtime(e):
+    # scanned entries carry their stat result, plain paths need a syscall
+    if hasattr(e, "mtime"):
+        return e.mtime
+    return os.path.getmtime(e)
+
 def run(params, path, dirs, files, logger=None):
     """
     @param string path
@@ -12,12 +19,12 @@ def run(params, path, dirs, files, logger=None):
 
     # only get most recent files
     if most_recent_x and len(files) > 0:
-        mtime_fname_l = []
-        for e in files:
-            mtime_fname_l.append((os.path.getmtime(e), e))
-        mtime_fname_l.sort(reverse=True)
+        # bounded heap, same picks as sorting all (mtime, path) in reverse
+        mtime_fname_l = heapq.nlargest(
+            most_recent_x,
+            ((_getmtime(e), e) for e in files))
         # for e in mtime_fname_l:
         #     print e
-        files = set(zip(*(mtime_fname_l[:most_recent_x]))[1])
+        files = set(e for mtime, e in mtime_fname_l)
 
     return dirs, files
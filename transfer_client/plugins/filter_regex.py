@@ -1,6 +1,18 @@
 import os
 import re
 
+g_pattern_map = {}  # key = pattern string, value = compiled case-insensitive regex
+
+def _compile(pattern):
+    """
+    compile each pattern once per run, shared by every root that uses it
+    """
+    compiled = g_pattern_map.get(pattern)
+    if compiled is None:
+        compiled = re.compile(pattern, re.IGNORECASE)
+        g_pattern_map[pattern] = compiled
+    return compiled
+
 def run(params, path, dirs, files, logger=None):
     """
     @param string path
@@ -15,20 +27,10 @@ def run(params, path, dirs, files, logger=None):
     # regex match filter
 
     if directory_re:
-        dirs = filter(
-            lambda e:
-                re.match(
-                    directory_re,
-                    os.path.basename(e),
-                    re.IGNORECASE),
-            dirs)
+        match = _compile(directory_re).match
+        dirs = [e for e in dirs if match(os.path.basename(e))]
     if filename_re:
-        files = filter(
-            lambda e:
-                re.match(
-                    filename_re,
-                    os.path.basename(e),
-                    re.IGNORECASE),
-            files)
+        match = _compile(filename_re).match
+        files = [e for e in files if match(os.path.basename(e))]
 
     return dirs, files
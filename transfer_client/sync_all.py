@@ -11,8 +11,10 @@ import socket
 import zlib
 import traceback
 import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
-from sync_all_lib import set_params, setup_logging, get_dirs_files, get_files, copy_resize_rotate, upload, cleanup_output_path, send_remote_command, remote_get_files, remote_delete_files, transfer_params_t
+from sync_all_lib import set_params, setup_logging, get_files_all, save_caches, write_stats, copy_resize_rotate, sync_pipeline, upload, cleanup_output_path, close_connections, remote_diff_files, remote_sync_files, remote_delete_files, transfer_params_t
 
 from plugins import \
     filter_picasa, \
@@ -20,10 +22,36 @@ from plugins import \
     filter_recent, \
     filter_regex
 
+def sync_host(logger, params, host, port, all_output_files):
+    """
+    bring one frame in line with all_output_files
+    """
+    upload_files = None
+    if params.get("upload_method") == "frameserver":
+        # frameservers with the sync command delete what we don't have
+        # and tell us what they are missing in a single exchange
+        upload_files = remote_sync_files(host, port, all_output_files)
+
+    if upload_files is not None:
+        upload(upload_files, host, port)
+    else:
+        # list remote files to find ones missing or different there, and
+        # ones to be deleted that don't exist locally
+        upload_files, delete_files = remote_diff_files(host, port, list(all_output_files))
+        upload(upload_files, host, port)
+
+        # remove renote files
+        if len(delete_files): logger.info("num files to be deleted remotely on %s: %d" % (host, len(delete_files)))
+        for f in delete_files:
+            logger.debug("delete file remotely: %s" % f)
+        if delete_files:
+            remote_delete_files(host, port, list(delete_files))
+
 def main(logger):
     params = {
         "PI-HOST": None, #"192.168.1.34",
         "PI-PORT": 9999,
+        "PI-HOSTS": [],  # several frames synced at once, "host" or "host:port", instead of PI-HOST
         "output_path": r"D:\!Dropbox.com\Dropbox (Personal)\sync_output",
         "scp_cmdline": [
             r"D:\Progs\pscp.exe",
@@ -31,8 +59,21 @@ def main(logger):
             "-pw",
             "pi",
         ],
+        "upload_method": "frameserver",  # or "scp" to upload with scp_cmdline
         "output_jpg_size": 2048,
         "output_jpg_quality": 55,
+        "resize_workers": multiprocessing.cpu_count(),
+        "scan_workers": 8,  # roots and subtrees scanned concurrently, mostly waiting on the disk/share
+        "resize_engine": "convert",  # or "pil" to resize in-process with PIL/Pillow
+        "rotate_in_resize": True,  # apply the EXIF orientation while resizing instead of a jhead pass
+        "pool_max_idle": 1,  # idle sessions kept per frame, each holds one of the server's --workers
+        "upload_streams": 4,  # files uploaded concurrently, the frames are on high latency Wi-Fi
+        "upload_retries": 3,  # attempts per file after the first one fails
+        "upload_backoff": 1.0,  # seconds before the first retry, doubled for each one after
+        "stats_file": os.path.join(tempfile.gettempdir(), "sync_all_stats.json"),  # per stage timings of the last run
+        "pipeline": False,  # upload each file as soon as it is resized instead of after all of them
+        "pipeline_queue_size": 64,  # files held between pipeline stages before the producer waits
+        "pipeline_upload_batch": 8,  # most files handed to upload() at once
         "imagemagick_convert_binary":  # from ImageMagick-6.9.3-7-portable-Q16-x64
             r"D:\!Dropbox.com\Dropbox (Personal)\raspberrypi-frameserver\transfer_client\convert.exe",
         "jhead_binary":  # on windows, jpegtran.exe must be in the same path
@@ -43,6 +84,11 @@ def main(logger):
     HOST = params["PI-HOST"]
     PORT = int(params["PI-PORT"])
 
+    hosts = []  # (host, port) of every frame to sync
+    for h in params["PI-HOSTS"] or ([HOST] if HOST is not None else []):
+        host, _, port = h.partition(":")
+        hosts.append((host, int(port or PORT)))
+
     transfer_params_l = [
         transfer_params_t(
             r"D:\!Memories\staging area\Eye-Fi",
@@ -101,36 +147,49 @@ def main(logger):
         ),
     ]
 
-    files = set()
-    for p in transfer_params_l:
-        files |= get_files(p)
-    logger.info("TOTAL FILES TO SYNC: %d (cached in %s)" % (len(files), params["output_path"]))
-
-    # resize rotate and copy the files
-    new_files, not_new_files = copy_resize_rotate(files, params["output_path"])
-    all_output_files = new_files | not_new_files
-    if len(new_files): logger.info("FILES RESIZED: %d" % len(new_files))
-
-    script = cleanup_output_path(params["output_path"], all_output_files)
-
-    if HOST is None:
-        logger.info("No HOST specified, skipping upload")
-    else:
-        # list remote files to find ones to be deleted that don't exist locally
-        local_files = set(map(lambda f: os.path.basename(f).lower(), list(all_output_files)))
-        remote_files = set(remote_get_files(HOST, PORT))
-
-        # upload files that don't exist on remote
-        upload_files = local_files - remote_files
-        upload(map(lambda f: os.path.join(params["output_path"], f), list(upload_files)))
-
-        # remove renote files
-        delete_files = remote_files - local_files
-        if len(delete_files): logger.info("num files to be deleted remotely: %d" % len(delete_files))
-        for f in delete_files:
-            logger.debug("delete file remotely: %s" % f)
-        if delete_files:
-            remote_delete_files(HOST, PORT, list(delete_files))
+    try:
+        if params.get("pipeline"):
+            # scan, resize and upload overlapped, the remote clean up below
+            # then only has deletes and whatever failed to upload left
+            all_output_files = sync_pipeline(transfer_params_l, params["output_path"], hosts)
+            logger.info("TOTAL FILES TO SYNC: %d (cached in %s)" % (len(all_output_files), params["output_path"]))
+        else:
+            files = get_files_all(transfer_params_l)
+            save_caches(transfer_params_l)
+            logger.info("TOTAL FILES TO SYNC: %d (cached in %s)" % (len(files), params["output_path"]))
+
+            # resize rotate and copy the files
+            new_files, not_new_files = copy_resize_rotate(files, params["output_path"])
+            all_output_files = new_files | not_new_files
+            if len(new_files): logger.info("FILES RESIZED: %d" % len(new_files))
+
+        script = cleanup_output_path(params["output_path"], all_output_files)
+
+        def sync_one(h):
+            # one unreachable frame must not keep the others from syncing
+            try:
+                sync_host(logger, params, h[0], h[1], all_output_files)
+                return True
+            except Exception:
+                logger.error("sync to %s:%d failed" % h)
+                logger.error(traceback.format_exc())
+                return False
+
+        if not hosts:
+            logger.info("No HOST specified, skipping upload")
+        else:
+            # scanned and resized once, each frame is then synced on its own thread
+            pool = ThreadPool(len(hosts))
+            try:
+                synced = pool.map(sync_one, hosts)
+            finally:
+                pool.close()
+                pool.join()
+            if not all(synced):
+                logger.error("%d of %d frames failed to sync" % (synced.count(False), len(hosts)))
+    finally:
+        close_connections()
+        write_stats(params["stats_file"])
 
 
 if __name__ == "__main__":
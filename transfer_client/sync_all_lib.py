@@ -11,6 +11,31 @@ import socket
 import zlib
 import traceback
 import tempfile
+import threading
+import json
+import hashlib
+import struct
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import collections
+import cPickle
+import stat
+import Queue
+import math
+import select
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # backport for python 2
+    except ImportError:
+        scandir = None
 
 from plugins import \
     filter_picasa, \
@@ -21,6 +46,10 @@ from plugins import \
 def set_params(params):
     global g_params
     g_params = params
+    # filters that keep a cache of their own put it next to the scan cache
+    for f in (filter_picasa, filter_hash, filter_recent, filter_regex):
+        if hasattr(f, "set_cache_path"):
+            f.set_cache_path(params.get("scan_cache_path", tempfile.gettempdir()))
 
 def setup_logging():
     global g_lgr
@@ -57,6 +86,82 @@ def setup_logging():
 
     return g_lgr
 
+class stage_stats_t(object):
+    """
+    totals of one instrumented stage. stages nest, e.g. the filters run
+    inside get_files, so their wall times are not meant to be added up.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.count = 0  # files handled
+        self.bytes = 0
+        self.latencies = []  # seconds per file, or per call where there are no files
+
+g_stats = {}  # key = stage name, value = stage_stats_t
+g_stats_lock = threading.Lock()
+g_stats_started = time.time()
+
+def _stat(stage, wall, count=0, nbytes=0):
+    """
+    add one call of stage, taking wall seconds over count files
+    """
+    with g_stats_lock:
+        s = g_stats.setdefault(stage, stage_stats_t())
+        s.calls += 1
+        s.wall += wall
+        s.count += count
+        s.bytes += nbytes
+
+def _stat_latency(stage, seconds):
+    with g_stats_lock:
+        g_stats.setdefault(stage, stage_stats_t()).latencies.append(seconds)
+
+def _percentile(values, p):
+    """
+    nearest rank percentile of a sorted list
+    """
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+def write_stats(filename):
+    """
+    dump the stage totals of this run as json, with p50/p95 latencies
+    """
+    stages = {}
+    with g_stats_lock:
+        for stage, s in g_stats.items():
+            latencies = sorted(s.latencies)
+            stages[stage] = {
+                "calls": s.calls,
+                "wall": round(s.wall, 3),
+                "count": s.count,
+                "bytes": s.bytes,
+                "p50": _percentile(latencies, 50),
+                "p95": _percentile(latencies, 95),
+            }
+    with open(filename, "w") as fp:
+        json.dump({
+            "started": g_stats_started,
+            "wall": round(time.time() - g_stats_started, 3),
+            "stages": stages,
+        }, fp, indent=1, sort_keys=True)
+    g_lgr.info("run stats written to %s" % filename)
+
+def _run_filter(f, params, path, dirs, files):
+    """
+    f.run, timed under the plugin's name
+    """
+    t = time.time()
+    try:
+        return f.run(params, path, dirs, files, g_lgr)
+    finally:
+        elapsed = time.time() - t
+        stage = f.__name__.split(".")[-1]  # e.g. filter_picasa
+        _stat(stage, elapsed, len(files))
+        _stat_latency(stage, elapsed)
+
 transfer_params_t = namedtuple(
     "transfer_params_t", [
         "path",
@@ -65,13 +170,133 @@ transfer_params_t = namedtuple(
     ]
 )
 
+class path_entry_t(str):
+    """
+    full path of a directory entry that remembers what the walker learnt
+    about it: its type from the directory listing (d_type) and, once asked
+    for, its stat result. being a str it works anywhere a path does, while
+    filters can call stat() without another syscall.
+    """
+    def __new__(cls, path, dir_entry=None, st=None):
+        self = str.__new__(cls, path)
+        self._dir_entry = dir_entry
+        self._stat = st
+        return self
+
+    @property
+    def name(self):
+        return os.path.basename(self)
+
+    def stat(self):
+        if self._stat is None:
+            if self._dir_entry is not None:
+                self._stat = self._dir_entry.stat()  # free on windows
+            else:
+                self._stat = os.stat(self)
+        return self._stat
+
+    @property
+    def mtime(self):
+        return self.stat().st_mtime
+
+    def __getstate__(self):
+        # only the path goes into the scan cache. a file edited in place
+        # doesn't touch its directory's mtime, so a saved stat would go
+        # stale without the cache noticing; the next run stats it afresh
+        return {"_dir_entry": None, "_stat": None}
+
+def _list_dir(path):
+    """
+    @return ([] dirs, [] files) as path_entry_t, with at most one stat per
+            entry and none where the listing already has the entry type
+    """
+    dirs, files = [], []
+    if scandir is not None:
+        for de in scandir(path):
+            e = path_entry_t(os.path.join(path, de.name), de)
+            if de.is_dir():
+                dirs.append(e)
+            elif de.is_file():
+                files.append(e)
+    else:
+        for p in os.listdir(path):
+            try:
+                e = path_entry_t(os.path.join(path, p), None, os.stat(os.path.join(path, p)))
+            except OSError:  # dangling link
+                continue
+            if stat.S_ISDIR(e.stat().st_mode):
+                dirs.append(e)
+            elif stat.S_ISREG(e.stat().st_mode):
+                files.append(e)
+    return dirs, files
+
+g_scan_cache = None  # key = directory path, value = (cache key, dirs, files)
+g_scan_cache_seen = set()  # directories looked up this run, the rest is dropped on save
+
+def _scan_cache_filename():
+    state_path = g_params.get("scan_cache_path", tempfile.gettempdir())
+    return os.path.join(state_path, "sync_all_scan_cache.pickle")
+
+def _get_scan_cache():
+    global g_scan_cache
+    if g_scan_cache is None:
+        try:
+            with open(_scan_cache_filename(), "rb") as fp:
+                g_scan_cache = cPickle.load(fp)
+        except (IOError, EOFError, AttributeError, cPickle.UnpicklingError):  # AttributeError: from an older version
+            g_scan_cache = {}
+    return g_scan_cache
+
+def save_scan_cache():
+    if g_scan_cache is None:
+        return
+    for path in set(g_scan_cache) - g_scan_cache_seen:
+        del g_scan_cache[path]
+    with open(_scan_cache_filename(), "wb") as fp:
+        cPickle.dump(g_scan_cache, fp, cPickle.HIGHEST_PROTOCOL)
+    g_lgr.debug("saved scan cache of %d directories" % len(g_scan_cache))
+
+def save_caches(transfer_params_l):
+    """
+    save the scan cache and the caches of filters that keep one (save_cache())
+    """
+    save_scan_cache()
+    saved = set()
+    for p in transfer_params_l:
+        for f_params in (p.local_filters or []) + (p.global_filters or []):
+            f = f_params[0] if isinstance(f_params, tuple) else f_params
+            if hasattr(f, "save_cache") and f not in saved:
+                f.save_cache()
+                saved.add(f)
+
+def _scan_cache_key(path, local_filters):
+    """
+    a directory's filtered listing stays valid while its mtime (changed by
+    any add, delete or rename in it), the filter configuration and whatever
+    extra state the filters report through cache_key() stay the same
+    """
+    key = [os.stat(path).st_mtime]
+    for f_params in local_filters or []:
+        if isinstance(f_params, tuple):
+            f, params = f_params
+        else:
+            f, params = f_params, None
+        extra = f.cache_key(params, path) if hasattr(f, "cache_key") else None
+        key.append((f.__name__, sorted(params.items()) if params else None, extra))
+    return key
+
 def get_dirs_files(path, local_filters):
-    items = os.listdir(path)
-    fullitems = map(lambda p: os.path.join(path, p), items)  # full path
+    use_cache = g_params.get("scan_cache", True)
+    if use_cache:
+        cache = _get_scan_cache()
+        g_scan_cache_seen.add(path)
+        key = _scan_cache_key(path, local_filters)
+        cached = cache.get(path)
+        if cached is not None and cached[0] == key:
+            return list(cached[1]), list(cached[2])
 
     # split between dirs and files
-    dirs = filter(os.path.isdir, fullitems)
-    files = filter(os.path.isfile, fullitems)
+    dirs, files = _list_dir(path)
 
     # per path filters e.g. filter_picasa
     if local_filters:
@@ -80,196 +305,1178 @@ def get_dirs_files(path, local_filters):
                 f, params = f_params
             else:
                 f, params = f_params, None
-            dirs, files = f.run(params, path, dirs, files, g_lgr)
+            dirs, files = _run_filter(f, params, path, dirs, files)
 
+    if use_cache:
+        cache[path] = (key, list(dirs), list(files))
     return dirs, files
 
-def get_files(transfer_param, path_override=None):
-    # gather viable image files into this set
-    files = set()
+# files are picked in three stages, chained with generators:
+#   walk_dirs       walks the tree below a root, depth first
+#   get_dirs_files  lists one directory and applies the local_filters to it
+#   select_files    applies the global_filters once, to everything under the root
 
+def walk_dirs(transfer_param, path_override=None):
+    """
+    yield (path, dirs, files) for the root and every directory below it
+    that the local filters let through, depth first in listing order
+    """
     if path_override is None:
         path = transfer_param.path
     else:
         path = path_override
 
-    p_dirs, p_files = get_dirs_files(
-        path,
-        transfer_param.local_filters)
+    stack = [path]
+    while stack:
+        path = stack.pop()
+        p_dirs, p_files = get_dirs_files(
+            path,
+            transfer_param.local_filters)
 
-    # log debug information
-    logger = g_lgr.debug # if len(p_dirs) == 0 and len(p_files) == 0 else g_lgr.info
-    logger("dirs:%d files:%d path: \"%s\"" % (
-            len(p_dirs),
-            len(p_files),
-            os.path.basename(path),
+        # log debug information
+        logger = g_lgr.debug # if len(p_dirs) == 0 and len(p_files) == 0 else g_lgr.info
+        logger("dirs:%d files:%d path: \"%s\"" % (
+                len(p_dirs),
+                len(p_files),
+                os.path.basename(path),
+            )
         )
-    )
-    for e in p_dirs:
-        g_lgr.debug("DIR \"%s\"" % e)
-    for e in p_files:
-        g_lgr.debug("FILE \"%s\"" % e)
+        for e in p_dirs:
+            g_lgr.debug("DIR \"%s\"" % e)
+        for e in p_files:
+            g_lgr.debug("FILE \"%s\"" % e)
 
-    files |= set(p_files)
+        yield path, p_dirs, p_files
+        stack.extend(reversed(p_dirs))
 
-    # recurse down the tree
-    for d in p_dirs:
-        files |= get_files(transfer_param, path_override=d)
+def iter_files(transfer_param, path_override=None):
+    for path, p_dirs, p_files in walk_dirs(transfer_param, path_override):
+        for f in p_files:
+            yield f
 
-    # process filters like filter_recent, filter_hash
+def select_files(transfer_param, files):
+    """
+    process filters like filter_recent, filter_hash. they pick from
+    everything under the root, so each one runs exactly once per root.
+    @param files iterable of files that passed the local filters
+    @return set of files
+    """
+    files = set(files)
     if transfer_param.global_filters:
         for f_params in transfer_param.global_filters:
             if isinstance(f_params, tuple):
                 f, params = f_params
             else:
                 f, params = f_params, None
-            _, files = f.run(params, None, None, files, g_lgr)
+            _, files = _run_filter(f, params, None, None, files)
+            files = set(files)
 
     return files
 
-def copy_resize_rotate(files, output_path):
+def get_files(transfer_param, path_override=None):
+    t = time.time()
+    files = select_files(transfer_param, iter_files(transfer_param, path_override))
+    _stat("get_files", time.time() - t, len(files))
+    return files
+
+def get_files_all(transfer_params_l):
     """
-    resize and rotate files
-    returns resized files and would be resized files
+    gather the files of every transfer root
+
+    with scan_workers > 1 the roots, and then each of their top level
+    subtrees, are scanned on a pool of threads. results are merged in
+    the order of transfer_params_l, so they don't depend on timing.
     """
-    new_files = set()  # new files to be copied over
-    not_new_files = set()
-    cnt_skip = 0
-    cnt_convert = 0
-    dst_size = g_params.get("output_jpg_size", 2048)
-    for idx, f in enumerate(sorted(files)):
-        src, dst = f, os.path.join(output_path, os.path.basename(f))
+    workers = g_params.get("scan_workers", 1)
+    if workers <= 1:
+        files = set()
+        for p in transfer_params_l:
+            files |= get_files(p)
+        return files
 
-        # if file already exists, then don't resize, and don't add to new_files set
-        if os.path.isfile(dst):
-            g_lgr.debug("skipping file '%s' because dst:'%s' already exists" % (src, dst))
-            cnt_skip += 1
-            not_new_files.add(dst)
-            continue
+    if g_params.get("scan_cache", True):
+        _get_scan_cache()  # load once, before the threads race for it
 
-        if not src.lower().endswith("jpg"):
-            g_lgr.error("skipping file '%s' because it is not a jpeg!!!" % (src))
-            continue
+    t = time.time()
+    pool = ThreadPool(workers)
+    try:
+        # first level of every root
+        tops = pool.map(
+            lambda p: get_dirs_files(p.path, p.local_filters),
+            transfer_params_l)
+        # then every subtree below it as its own task
+        tasks = []
+        for idx, (p, (p_dirs, p_files)) in enumerate(zip(transfer_params_l, tops)):
+            g_lgr.debug("dirs:%d files:%d path: \"%s\"" % (len(p_dirs), len(p_files), os.path.basename(p.path)))
+            for d in p_dirs:
+                tasks.append((idx, p, d))
+        subtrees = pool.map(
+            lambda t: set(iter_files(t[1], path_override=t[2])),
+            tasks)
+    finally:
+        pool.close()
+        pool.join()
 
+    root_files = map(lambda t: set(t[1]), tops)
+    for (idx, p, d), subtree_files in zip(tasks, subtrees):
+        root_files[idx] |= subtree_files
+
+    files = set()
+    for p, p_files in zip(transfer_params_l, root_files):
+        files |= select_files(p, p_files)
+    g_lgr.debug("scanned %d roots and %d subtrees on %d threads" % (len(transfer_params_l), len(tasks), workers))
+    _stat("get_files", time.time() - t, len(files))
+    return files
+
+EXIF_ORIENTATION = 274
+
+# EXIF orientation -> PIL transpose that turns the image upright
+g_orientation_transpose = {
+    2: "FLIP_LEFT_RIGHT",
+    3: "ROTATE_180",
+    4: "FLIP_TOP_BOTTOM",
+    5: "TRANSPOSE",
+    6: "ROTATE_270",
+    7: "TRANSVERSE",
+    8: "ROTATE_90",
+}
+
+class rotate_error_t(Exception):
+    pass
+
+def _resize_pil(src, dst, dst_size, quality, autorotate):
+    """
+    in-process equivalent of convert [-auto-orient] -resize "WxH>" -quality Q
+    @return bool True if the image was auto rotated in the same pass
+    """
+    img = Image.open(src)
+    # have the jpeg decoder scale by 1/2, 1/4 or 1/8 in the DCT domain.
+    # it picks the smallest scale that still covers the requested size in
+    # both dimensions, so ask for the actual target, long edge dst_size,
+    # not the square box which the short edge would never reach
+    w, h = img.size
+    scale = float(dst_size) / max(w, h)
+    if scale < 1:
+        img.draft("RGB", (max(1, int(w * scale)), max(1, int(h * scale))))
+    img.thumbnail((dst_size, dst_size), Image.ANTIALIAS)  # only ever shrinks
+
+    if not autorotate or not hasattr(img, "getexif"):  # Pillow < 6 leaves it to jhead
+        kwargs = {"quality": quality}
+        if "exif" in img.info:
+            kwargs["exif"] = img.info["exif"]  # keep the orientation for jhead
+        img.save(dst, "JPEG", **kwargs)
+        return False
+
+    try:
+        # the bounding box is square, so rotating after the resize is the same
+        exif = img.getexif()
+        transpose = g_orientation_transpose.get(exif.get(EXIF_ORIENTATION))
+        if transpose:
+            img = img.transpose(getattr(Image, transpose))
+        exif[EXIF_ORIENTATION] = 1
+        exif = exif.tobytes()
+    except Exception:
+        raise rotate_error_t(traceback.format_exc())
+    img.save(dst, "JPEG", quality=quality, exif=exif)
+    return True
+
+def _resize_rotate(job):
+    """
+    resize and auto rotate one file. runs in a worker process when
+    resize_workers > 1, so it only reports back and doesn't log.
+    a failed convert raises, a failed rotate removes dst.
+
+    with rotate_in_resize the EXIF orientation is applied (and reset) while
+    resizing, and jhead is only needed when the engine can't do that
+    @param job (src, dst, params)
+    @return (dst, rotated, error) error is the traceback of a failed rotate
+    """
+    src, dst, params = job
+    dst_size = params.get("output_jpg_size", 2048)
+    autorotate = params.get("rotate_in_resize", True)
+    if params.get("resize_engine", "convert") == "pil":
+        try:
+            rotated = _resize_pil(src, dst, dst_size, params.get("output_jpg_quality", 55), autorotate)
+        except rotate_error_t as ex:
+            return dst, False, str(ex)
+    else:
         args = [
-            g_params["imagemagick_convert_binary"],
+            params["imagemagick_convert_binary"],
             src,
+        ]
+        if autorotate:
+            args.append("-auto-orient")  # also resets the orientation tag
+        args += [
             "-quality",
-            str(g_params.get("output_jpg_quality", 55)),
+            str(params.get("output_jpg_quality", 55)),
             "-resize",
             "%dx%d>" % (dst_size, dst_size),
             dst,
         ]
-        g_lgr.debug("resizing file '%s' to '%s' (%d of %d)" % (src, dst, idx + 1, len(files)))
-        g_lgr.debug(" ".join(args))
         subprocess.check_output(
             args,
             stderr=subprocess.STDOUT,
         )
+        rotated = autorotate
 
-        cnt_convert += 1
+    if rotated:
+        return dst, True, None
 
-        if g_params["jhead_binary"]:
-            args = [
-                g_params["jhead_binary"],
-                "-autorot",
-                dst,
-            ]
-            g_lgr.debug("auto rotate file '%s'" % (dst))
-            g_lgr.debug(" ".join(args))
-            try:
-                subprocess.check_output(
-                    args,
-                    stderr=subprocess.STDOUT,
-                    cwd=os.path.dirname(g_params["jhead_binary"]),
-                )
-                new_files.add(dst)
-            except subprocess.CalledProcessError as ex:
-                g_lgr.warning("removing file that could not be rotated %s" % dst)
-                g_lgr.error(traceback.format_exc())
-                try:
-                    os.remove(dst)
-                except:
-                    pass
+    if not params["jhead_binary"]:
+        return dst, False, None
 
-    if cnt_convert: g_lgr.info("Resized %d files (%d skipped)" % (cnt_convert, cnt_skip))
+    args = [
+        params["jhead_binary"],
+        "-autorot",
+        dst,
+    ]
+    try:
+        subprocess.check_output(
+            args,
+            stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(params["jhead_binary"]),
+        )
+        return dst, True, None
+    except subprocess.CalledProcessError as ex:
+        error = traceback.format_exc()
+        try:
+            os.remove(dst)
+        except:
+            pass
+        return dst, False, error
+
+OUTPUT_MANIFEST = ".sync_manifest.pickle"
+
+g_output_manifest = None  # (output_path, {} key = output name, value = source path, set of file names in output_path on load)
+
+def _get_output_manifest(output_path):
+    """
+    index of the files rendered into output_path. every name in it encodes
+    its source and render parameters, so membership is the whole skip check.
+    entries are only made once a render succeeded.
+    @return {} manifest
+    """
+    global g_output_manifest
+    if g_output_manifest is None or g_output_manifest[0] != output_path:
+        # the one listing of output_path per run: outputs deleted behind our
+        # back are forgotten, so rendered again instead of skipped, and
+        # cleanup_output_path compares against it
+        present = set(map(lambda e: e.name, _list_dir(output_path)[1]))
+        try:
+            with open(os.path.join(output_path, OUTPUT_MANIFEST), "rb") as fp:
+                manifest = cPickle.load(fp)
+            for name in set(manifest) - present:
+                del manifest[name]
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            manifest = {}
+        g_output_manifest = (output_path, manifest, present)
+    return g_output_manifest[1]
+
+def _save_output_manifest(output_path):
+    manifest = _get_output_manifest(output_path)
+    with open(os.path.join(output_path, OUTPUT_MANIFEST), "wb") as fp:
+        cPickle.dump(manifest, fp, cPickle.HIGHEST_PROTOCOL)
+
+def _output_name(src, params):
+    """
+    output file name keyed by the source identity (path, size, mtime) and
+    the render parameters, e.g. IMG_0001_1a2b3c4d.jpg. a changed source or
+    output_jpg_size/quality gives a new name, and same-named photos from
+    different folders no longer share one.
+    """
+    st = src.stat() if hasattr(src, "stat") else os.stat(src)
+    key = "|".join(map(str, [
+        src,
+        st.st_size,
+        repr(st.st_mtime),
+        params.get("output_jpg_size", 2048),
+        params.get("output_jpg_quality", 55),
+        params.get("resize_engine", "convert"),
+        params.get("rotate_in_resize", True),
+    ]))
+    stem, ext = os.path.splitext(os.path.basename(src))
+    return "%s_%s%s" % (stem, hashlib.md5(key).hexdigest()[:8], ext)
+
+def _timed_resize_rotate(job):
+    """
+    _resize_rotate and the seconds it took, measured in the worker.
+    a failed convert comes back as an error string: CalledProcessError
+    can't be unpickled in the parent, and would hang the pool's result thread
+    """
+    t = time.time()
+    try:
+        result = _resize_rotate(job)
+    except Exception as ex:
+        src, dst, params = job
+        error = "could not resize '%s'\n%s%s" % (src, traceback.format_exc(), getattr(ex, "output", None) or "")
+        try:
+            os.remove(dst)  # partly written
+        except OSError:
+            pass
+        result = dst, False, error
+    return result, time.time() - t
+
+def copy_resize_rotate(files, output_path):
+    """
+    resize and rotate files
+    returns resized files and would be resized files
+    """
+    new_files = set()  # new files to be copied over
+    not_new_files = set()
+    for dst, is_new in iter_resize_rotate(sorted(files), output_path, len(files)):
+        if is_new:
+            new_files.add(dst)
+        else:
+            not_new_files.add(dst)
 
     # return list of newly resized files (to be used to upload)
     return new_files, not_new_files
 
-def upload(files):
+def iter_resize_rotate(files, output_path, total=None):
+    """
+    resize and rotate files as they come in
+    yields (output file, bool newly resized) as soon as each one is ready,
+    files that fail to convert are left out. a None in files is no file,
+    just a chance to hand over renders that finished in the meantime.
+
+    with resize_workers > 1 the files are converted on a pool of worker
+    processes, with at most twice that many files in flight
+    """
+    cnt_skip = 0
+    cnt_convert = 0
+    workers = g_params.get("resize_workers", 1)
+    params = g_params
+    if params.get("resize_engine", "convert") == "pil" and Image is None:
+        g_lgr.warning("resize_engine 'pil' needs PIL/Pillow, resizing with convert")
+        params = dict(g_params, resize_engine="convert")
+    manifest = _get_output_manifest(output_path)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    in_flight = collections.deque()
+    t = time.time()
+    stats = [0, 0]  # files resized, bytes written
+    rendering = {}  # key = output file, value = source path, entered in the manifest once done
+
+    def collect(timed_result):
+        (dst, rotated, error), elapsed = timed_result
+        _stat_latency("copy_resize_rotate", elapsed)
+        src = rendering.pop(dst)
+        if error:
+            g_lgr.warning("leaving out file that could not be resized or rotated %s" % dst)
+            g_lgr.error(error)
+            return None
+        stats[1] += os.path.getsize(dst)
+        manifest[os.path.basename(dst)] = src
+        return dst
+
+    try:
+        idx = -1
+        for f in files:
+            # before waiting on more input, hand over what finished meanwhile
+            while in_flight and in_flight[0].ready():
+                done = collect(in_flight.popleft().get())
+                if done:
+                    yield done, True
+            if f is None:
+                continue
+            idx += 1
+            src = f
+            name = _output_name(src, params)
+            dst = os.path.join(output_path, name)
+
+            # if file already exists, then don't resize, and don't add to new_files set
+            if name in manifest:
+                g_lgr.debug("skipping file '%s' because dst:'%s' already exists" % (src, dst))
+                cnt_skip += 1
+                yield dst, False
+                continue
+
+            if not src.lower().endswith("jpg"):
+                g_lgr.error("skipping file '%s' because it is not a jpeg!!!" % (src))
+                continue
+
+            rendering[dst] = str(src)
+
+            g_lgr.debug("resizing file '%s' to '%s' (%d of %s)" % (src, dst, idx + 1, total or "?"))
+            job = (src, dst, params)
+            if pool is None:
+                if collect(_timed_resize_rotate(job)):
+                    yield dst, True
+            else:
+                if len(in_flight) >= workers * 2:
+                    done = collect(in_flight.popleft().get())
+                    if done:
+                        yield done, True
+                in_flight.append(pool.apply_async(_timed_resize_rotate, (job,)))
+
+            cnt_convert += 1
+            stats[0] = cnt_convert
+
+        while in_flight:
+            done = collect(in_flight.popleft().get())
+            if done:
+                yield done, True
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        _stat("copy_resize_rotate", time.time() - t, stats[0], stats[1])
+
+    if cnt_convert: g_lgr.info("Resized %d files (%d skipped)" % (cnt_convert, cnt_skip))
+
+class put_unsupported_t(Exception):
+    """
+    the frameserver can't receive files, upload() falls back to scp
+    """
+    pass
+
+def upload(files, host=None, port=None):
     """
     upload the list of files to the raspberry pi
+
+    with upload_streams > 1 the files are split over that many concurrent
+    frameserver sessions, or scp processes
+    @param host defaults to PI-HOST, and port to PI-PORT
     """
-    cnt = 0
-    for idx, f in enumerate(sorted(files)):
+    if host is None:
+        host, port = g_params["PI-HOST"], int(g_params["PI-PORT"])
+    files = sorted(files)
+    if not files:
+        return
+    streams = max(1, min(g_params.get("upload_streams", 1), len(files)))
+    chunks = [files[i::streams] for i in range(streams)]
+    t = time.time()
+
+    uploaded = None
+    if g_params.get("upload_method", "scp") == "frameserver":
+        try:
+            uploaded = _map_streams(lambda chunk: remote_put_files(host, port, chunk), chunks)
+        except put_unsupported_t:
+            g_lgr.warning("frameserver on %s can't receive files, falling back to scp" % host)
+    if uploaded is None:
+        uploaded = _map_streams(lambda chunk: _scp_files(host, chunk), chunks)
+
+    elapsed = time.time() - t
+    size = sum(map(os.path.getsize, uploaded))
+    _stat("upload", elapsed, len(uploaded), size)
+    g_lgr.info("Uploaded %d files to %s, %.1f MB in %.1fs (%.2f MB/s over %d streams)" % (
+        len(uploaded), host, size / 1e6, elapsed, size / 1e6 / elapsed if elapsed else 0.0, streams))
+
+def _map_streams(func, chunks):
+    """
+    run func on every chunk, each on its own thread
+    @return [] of the files uploaded by all of them
+    """
+    if len(chunks) == 1:
+        return func(chunks[0])
+    pool = ThreadPool(len(chunks))
+    try:
+        results = pool.map(func, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    return sum(results, [])
+
+def _upload_backoff(attempt):
+    """
+    seconds to wait before retrying a failed upload, doubling every attempt
+    """
+    return g_params.get("upload_backoff", 1.0) * (2 ** attempt)
+
+def _scp_files(host, files):
+    """
+    upload files with scp_cmdline one at a time, retrying each with backoff
+    @return [] of uploaded files
+    """
+    retries = g_params.get("upload_retries", 3)
+    uploaded = []
+    for idx, f in enumerate(files):
         src = f
-        dst = "pi@%s:photos/%s" % (g_params["PI-HOST"], os.path.basename(f).lower())
+        dst = "pi@%s:photos/%s" % (host, os.path.basename(f).lower())
         args = g_params["scp_cmdline"] + [src, dst]
         g_lgr.info("uploading file '%s' to '%s' (%d of %d)" % (os.path.basename(src), dst, idx + 1, len(files)))
         g_lgr.debug(" ".join(args))
-        subprocess.check_output(
-            args,
-            stderr=subprocess.STDOUT,
-        )
-        cnt += 1
-    if len(files): g_lgr.info("Uploaded %d files" % len(files))
+        t = time.time()
+        for attempt in range(retries + 1):
+            try:
+                subprocess.check_output(
+                    args,
+                    stderr=subprocess.STDOUT,
+                )
+                break
+            except subprocess.CalledProcessError as e:
+                if attempt == retries:
+                    raise
+                g_lgr.warning("upload of '%s' failed, retrying (%d of %d)" % (f, attempt + 1, retries))
+                g_lgr.debug(e.output)
+                time.sleep(_upload_backoff(attempt))
+        _stat_latency("upload", time.time() - t)
+        uploaded.append(f)
+    return uploaded
 
-def cleanup_output_path(output_path, output_files):
-    items = os.listdir(output_path)
-    fullitems = map(lambda p: os.path.join(output_path, p), items)  # full path
+def remote_put_files(host, port, files):
+    """
+    upload files over one frameserver session with the put command.
+    a file whose transfer is cut off is retried on a new connection,
+    resuming where the server's partial copy ends. a refused put is
+    retried too: the handler of the dropped connection holds on to the
+    name until the server's --timeout notices it is gone.
+    @return [] of uploaded files
+    """
+    conn, _ = _acquire_connection(host, port)
+    if conn is None:
+        raise put_unsupported_t("no session support on %s:%d" % (host, port))
 
-    # split between dirs and files
-    files = set(filter(os.path.isfile, fullitems))
+    retries = g_params.get("upload_retries", 3)
+    uploaded = []
+    for idx, f in enumerate(sorted(files)):
+        name = os.path.basename(f).lower()
+        g_lgr.info("uploading file '%s' to '%s:%d' (%d of %d)" % (os.path.basename(f), host, port, idx + 1, len(files)))
+        t = time.time()
+        for attempt in range(retries + 1):
+            try:
+                if conn is None:
+                    conn = remote_connection_t(host, port)
+                recv = conn.send_file(name, f)
+            except socket.error:
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                if attempt == retries:
+                    raise
+                g_lgr.warning("upload of '%s' interrupted, retrying (%d of %d)" % (f, attempt + 1, retries))
+                g_lgr.debug(traceback.format_exc())
+                time.sleep(_upload_backoff(attempt))
+                continue
+            if recv[:1] != ["error"] or attempt == retries:
+                break
+            g_lgr.warning("upload of '%s' refused (%s), retrying (%d of %d)" % (f, " ".join(recv[1:]), attempt + 1, retries))
+            time.sleep(_upload_backoff(attempt))
+        if not recv:
+            conn.close()
+            raise put_unsupported_t("%s:%d has no put command" % (host, port))
+        if recv[0] != "ok":
+            g_lgr.error("upload of '%s' failed: %s" % (f, " ".join(recv)))
+            continue
+        _stat_latency("upload", time.time() - t)
+        uploaded.append(f)
+    if conn is not None:
+        _release_connection(conn)
+    return uploaded
+
+def cleanup_output_path(output_path, output_files):
+    t = time.time()
+    manifest = _get_output_manifest(output_path)
+    present = g_output_manifest[2]  # listed when the manifest was loaded
+    output_names = set(map(os.path.basename, output_files))
 
-    cleanup_files = files - output_files
+    # whatever was there or got rendered, and isn't an output of this run
+    cleanup_names = (present | set(manifest)) - output_names - set([OUTPUT_MANIFEST])
 
-    if len(cleanup_files): g_lgr.info("number of files to clean up: %d" % len(cleanup_files))
-    for f in cleanup_files:
+    if len(cleanup_names): g_lgr.info("number of files to clean up: %d" % len(cleanup_names))
+    for name in cleanup_names:
+        f = os.path.join(output_path, name)
         g_lgr.debug("cleanup '%s'" % f)
-        os.remove(f)
+        try:
+            os.remove(f)
+        except OSError:  # already gone
+            pass
+        manifest.pop(name, None)
+        present.discard(name)
 
-def send_remote_command(host, port, command, arguments):
-    if len(arguments) > 0:
-        data = command + "\t" + "\t".join(arguments)
-    else:
-        data = command
+    _save_output_manifest(output_path)
+    _stat("cleanup_output_path", time.time() - t, len(cleanup_names))
+
+class pipeline_stage_t(object):
+    """
+    counters of one pipeline stage. time waiting on input means the stage
+    upstream is the bottleneck, time blocked on output the one downstream.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.wait_in = 0.0
+        self.wait_out = 0.0
+        self.max_depth = 0  # most items seen queued on the output
+
+    def get(self, q, timeout=None):
+        t = time.time()
+        try:
+            return q.get(timeout=timeout)
+        finally:
+            self.wait_in += time.time() - t
 
+    def put(self, q, item):
+        self.max_depth = max(self.max_depth, q.qsize())
+        t = time.time()
+        q.put(item)
+        self.wait_out += time.time() - t
+
+def _pipeline_iter(q, stage, poll=None):
+    """
+    items of q up to the None that ends it. with poll, a None is also
+    yielded every poll seconds without input, so the consumer can get on
+    with other work while upstream is slow
+    """
+    while True:
+        try:
+            item = stage.get(q, poll)
+        except Queue.Empty:
+            yield None
+            continue
+        if item is None:
+            return
+        yield item
+
+def sync_pipeline(transfer_params_l, output_path, hosts=()):
+    """
+    scan, resize and upload as one stream: every root is scanned on a
+    thread feeding the resizer, and each rendered file a remote does
+    not have yet is handed to that remote's upload thread right away.
+    the queues between the stages are bounded by pipeline_queue_size, so
+    a slow stage holds back the ones before it instead of piling up files.
+    deleting remote files is left to the caller, once all outputs are known.
+    @param hosts [] of (host, port), empty to only overlap scanning and resizing
+    @return set of output files
+    """
+    queue_size = g_params.get("pipeline_queue_size", 64)
+    batch_size = g_params.get("pipeline_upload_batch", 8)
+    q_files = Queue.Queue(queue_size)
+    scan_stage = pipeline_stage_t("scan")
+    resize_stage = pipeline_stage_t("resize")
+    errors = []
+
+    uploads = []  # (host, port, queue, stage, remote files)
+    for host, port in hosts:
+        try:
+            remote_files = set(map(str.lower, remote_get_files_since(host, port)))
+        except Exception:
+            # an unreachable frame gets no upload thread, the caller's sync retries it
+            g_lgr.error("pipeline listing of %s failed, leaving it for the final sync" % host)
+            g_lgr.debug(traceback.format_exc())
+            continue
+        uploads.append((host, port, Queue.Queue(queue_size), pipeline_stage_t("upload %s" % host), remote_files))
+
+    def scan():
+        try:
+            seen = set()
+            for p in transfer_params_l:
+                for f in sorted(get_files(p)):
+                    if f in seen:
+                        continue
+                    seen.add(f)
+                    scan_stage.count += 1
+                    scan_stage.put(q_files, f)
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            q_files.put(None)
+
+    def upload_batches(host, port, q_upload, upload_stage):
+        failed = False
+        for f in _pipeline_iter(q_upload, upload_stage):
+            batch = [f]
+            while len(batch) < batch_size:
+                try:
+                    f = q_upload.get_nowait()
+                except Queue.Empty:
+                    break
+                if f is None:
+                    q_upload.put(None)  # seen again by _pipeline_iter
+                    break
+                batch.append(f)
+            if failed:
+                continue  # keep draining, the resizer must not block on us
+            try:
+                upload(batch, host, port)
+                upload_stage.count += len(batch)
+            except Exception:
+                # whatever is still missing is picked up after the pipeline
+                g_lgr.error("pipeline upload to %s failed, leaving the rest for the final sync" % host)
+                g_lgr.debug(traceback.format_exc())
+                failed = True
+
+    scan_thread = threading.Thread(target=scan, name="pipeline-scan")
+    scan_thread.daemon = True
+    scan_thread.start()
+    upload_threads = []
+    for host, port, q_upload, upload_stage, _ in uploads:
+        upload_thread = threading.Thread(target=upload_batches, name="pipeline-upload-%s" % host,
+                                         args=(host, port, q_upload, upload_stage))
+        upload_thread.daemon = True
+        upload_thread.start()
+        upload_threads.append(upload_thread)
+
+    t = time.time()
+    output_files = set()
+    try:
+        for dst, is_new in iter_resize_rotate(_pipeline_iter(q_files, resize_stage, 0.2), output_path):
+            output_files.add(dst)
+            resize_stage.count += 1
+            for host, port, q_upload, upload_stage, remote_files in uploads:
+                if os.path.basename(dst).lower() not in remote_files:
+                    resize_stage.put(q_upload, dst)
+    finally:
+        for _, _, q_upload, _, _ in uploads:
+            q_upload.put(None)
+        for upload_thread in upload_threads:
+            upload_thread.join()
+        while scan_thread.is_alive():  # resizer stopped early, unblock the scanner
+            try:
+                q_files.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        scan_thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    save_caches(transfer_params_l)
+    g_lgr.info("pipeline took %.1fs" % (time.time() - t))
+    for stage in [scan_stage, resize_stage] + map(lambda u: u[3], uploads):
+        g_lgr.info("pipeline %-6s %6d files, waiting on input %7.1fs, blocked on output %7.1fs, max queued %d" % (
+            stage.name, stage.count, stage.wait_in, stage.wait_out, stage.max_depth))
+    return output_files
+
+PROTOCOL_VERSION = 2
+COMPRESS_MIN_SIZE = 4096  # smaller payloads are not worth deflating
+FLAG_ZLIB = 1
+
+def _encode_frame(fields, compress=True):
+    """
+    frame = 1 byte flags, 4 byte payload length, payload
+    payload = for each field: 4 byte length, field bytes
+    """
+    payload = "".join(struct.pack(">I", len(f)) + f for f in fields)
+    flags = 0
+    if compress and len(payload) >= COMPRESS_MIN_SIZE:
+        payload = zlib.compress(payload)
+        flags |= FLAG_ZLIB
+    return struct.pack(">BI", flags, len(payload)) + payload
+
+def _read_frame(rfile):
+    """
+    @return [] fields of the next frame, None at EOF
+    """
+    header = rfile.read(5)
+    if len(header) < 5:
+        return None
+    flags, length = struct.unpack(">BI", header)
+    payload = rfile.read(length)
+    if len(payload) < length:
+        return None
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    fields = []
+    pos = 0
+    while pos < len(payload):
+        n, = struct.unpack_from(">I", payload, pos)
+        fields.append(payload[pos + 4:pos + 4 + n])
+        pos += 4 + n
+    return fields
+
+def _parse_line(line):
+    """
+    @return [] fields of a text protocol reply line
+    """
+    line = line.rstrip("\r\n")
+    return line.split("\t") if line else []
+
+class remote_connection_t(object):
+    """
+    keep-alive connection to a frameserver
+
+    commands are pipelined over the one socket and their replies read back
+    in order. protocol version 2 sessions exchange length-prefixed frames,
+    version 1 sessions tab separated lines. servers without session support
+    answer the handshake with an empty line, in which case keepalive is
+    False and the socket is unusable.
+    """
+    def __init__(self, host, port, version=None):
+        if version is None:
+            version = g_session_versions.get((host, port), PROTOCOL_VERSION)
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port), g_params.get("remote_timeout", 60))
+        self.rfile = self.sock.makefile("rb")
+        if version > 1:
+            self.sock.sendall("session\t%d\tzlib\n" % version)
+        else:
+            self.sock.sendall("session\n")
+        reply = _parse_line(self.rfile.readline())
+        self.keepalive = reply[:1] == ["ok"]
+        self.version = int(reply[1]) if self.keepalive and len(reply) > 1 else 1
+        self.binary = self.version > 1
+        self.last_used = time.time()
+
+    def _write_rows(self, rows):
+        if self.binary:
+            self.sock.sendall("".join(map(_encode_frame, rows)))
+        else:
+            self.sock.sendall("".join(map(lambda r: "\t".join(r) + "\n", rows)))
+
+    def _read_row(self):
+        if self.binary:
+            return _read_frame(self.rfile)
+        r = self.rfile.readline()
+        return _parse_line(r) if r else None
+
+    def _read_reply(self):
+        r = self._read_row()
+        if r is None:
+            raise socket.error("%s:%d closed the session" % (self.host, self.port))
+        return r
+
+    def send_commands(self, commands):
+        """
+        @param [] commands each a [] of command name and arguments
+        @return [] reply fields per command, None means the server hung up
+        """
+        self._write_rows(commands)
+        return map(lambda c: self._read_row(), commands)
+
+    def send_rows(self, command, rows):
+        """
+        send a command followed by rows of fields
+        @return [] reply fields
+        """
+        self._write_rows([command] + list(rows))
+        return self._read_reply()
+
+    def send_file(self, name, filename):
+        """
+        put one file, streamed from disk after a length header. resumes
+        from whatever part of it the server already has.
+        @return [] reply fields
+        """
+        size = os.path.getsize(filename)
+        self._write_rows([["offset", name, str(size)]])
+        offset = self._read_reply()
+        offset = int(offset[0]) if offset and offset[0].isdigit() else 0
+        if offset:
+            g_lgr.info("resuming upload of '%s' at %d of %d bytes" % (name, offset, size))
+        self._write_rows([["put", name, str(size), str(offset)]])
+        with open(filename, "rb") as fp:
+            fp.seek(offset)
+            chunk = fp.read(65536)
+            while chunk:
+                self.sock.sendall(chunk)
+                chunk = fp.read(65536)
+        return self._read_reply()
+
+    def close(self):
+        try:
+            self.rfile.close()
+            self.sock.close()
+        except socket.error:
+            pass
+
+g_conn_pool = {}  # key = (host, port), value = [] of idle remote_connection_t, at most pool_max_idle
+g_conn_pool_lock = threading.Lock()
+g_session_versions = {}  # key = (host, port), value = negotiated protocol version, 0 if the server only does one command per connection
+
+def _acquire_connection(host, port):
+    """
+    @return (remote_connection_t or None, bool reused)
+    """
+    while True:
+        with g_conn_pool_lock:
+            idle = g_conn_pool.get((host, port))
+            conn = idle.pop() if idle else None
+            version = g_session_versions.get((host, port), PROTOCOL_VERSION)
+        if conn is None:
+            break
+        if _connection_alive(conn):
+            return conn, True
+        conn.close()
+    if version == 0:
+        return None, False
+    conn = remote_connection_t(host, port, version)
+    if not conn.keepalive and version > 1:
+        # servers from before binary framing hang up on a versioned handshake
+        conn.close()
+        conn = remote_connection_t(host, port, 1)
+    if not conn.keepalive:
+        conn.close()
+        g_lgr.debug("%s:%d has no session support, using one connection per command" % (host, port))
+        with g_conn_pool_lock:
+            g_session_versions[(host, port)] = 0
+        return None, False
+    with g_conn_pool_lock:
+        g_session_versions[(host, port)] = conn.version
+    return conn, False
+
+def _connection_alive(conn):
+    """
+    an idle session is usable until the server's read timeout drops it.
+    the server never sends unprompted, so a readable socket means it hung up.
+    """
+    if time.time() - conn.last_used > g_params.get("remote_idle_timeout", 20):
+        return False
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return False
+    return not readable
+
+def _release_connection(conn):
+    """
+    keep conn for reuse, unless pool_max_idle sessions to its host are
+    already idle. each one ties up a server worker until it times out.
+    """
+    conn.last_used = time.time()
+    with g_conn_pool_lock:
+        idle = g_conn_pool.setdefault((conn.host, conn.port), [])
+        if len(idle) < g_params.get("pool_max_idle", 1):
+            idle.append(conn)
+            return
+    conn.close()
+
+def close_connections():
+    with g_conn_pool_lock:
+        for conns in g_conn_pool.values():
+            for conn in conns:
+                conn.close()
+        g_conn_pool.clear()
+
+def _send_oneshot(host, port, fields):
     # Create a socket (SOCK_STREAM means a TCP socket)
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     try:
         # Connect to server and send data
         sock.connect((host, port))
-        sock.sendall(data + "\n")
+        sock.sendall("\t".join(fields) + "\n")
 
-        received = ""
+        chunks = []
         # Receive data from the server and shut down
         r = sock.recv(4096)
-        received += r
         while r:
+            chunks.append(r)
             r = sock.recv(4096)
-            received += r
     finally:
         sock.close()
 
-    g_lgr.debug("Sent:     {}".format(data))
-    g_lgr.debug("Received: {}".format(received))
+    return _parse_line("".join(chunks))
+
+def send_remote_commands(host, port, commands):
+    """
+    send several commands over one pooled connection
+    @param [] commands (command, arguments) tuples
+    @return [] reply fields, in the order of commands
+    """
+    commands = map(lambda c: [c[0]] + list(c[1]), commands)
+
+    t = time.time()
+    conn, reused = _acquire_connection(host, port)
+    if conn is None:
+        received = map(lambda c: _send_oneshot(host, port, c), commands)
+    else:
+        try:
+            received = conn.send_commands(commands)
+            if reused and received[0] is None:
+                # idle connection was dropped by the server's read timeout
+                conn.close()
+                conn = remote_connection_t(host, port)
+                received = conn.send_commands(commands)
+            if None in received:
+                raise socket.error("%s:%d closed the session" % (host, port))
+        except:
+            conn.close()
+            raise
+        _release_connection(conn)
+
+    elapsed = (time.time() - t) / len(commands)  # pipelined, so shared evenly
+    for data, r in zip(commands, received):
+        _stat("remote %s" % data[0], elapsed, len(r), sum(map(len, r)))
+        _stat_latency("remote %s" % data[0], elapsed)
+        g_lgr.debug("Sent:     {}".format("\t".join(data)))
+        g_lgr.debug("Received: {}".format("\t".join(r)))
 
     return received
 
+def send_remote_command(host, port, command, arguments):
+    return send_remote_commands(host, port, [(command, arguments)])[0]
+
 def remote_get_files(host, port):
-    files_all = send_remote_command(host, port, "list", [])
-    if len(files_all.strip()) == 0: return []
-    files = files_all.split("\t")
-    files = map(lambda f: f.strip(), files)
+    files = send_remote_command(host, port, "list", [])
     for f in files:
         g_lgr.debug("remote file: '%s'" % f)
     g_lgr.debug("num remote files %d" % len(files))
     return files
 
+def _remote_state_filename(host, port):
+    state_path = g_params.get("remote_state_path", tempfile.gettempdir())
+    return os.path.join(state_path, "sync_all_remote_%s_%d.json" % (host, port))
+
+def _load_remote_state(host, port):
+    try:
+        with open(_remote_state_filename(host, port), "rb") as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+def _save_remote_state(host, port, state):
+    with open(_remote_state_filename(host, port), "wb") as fp:
+        json.dump(state, fp)
+
+def remote_get_files_since(host, port):
+    """
+    remote listing kept in a local state file and brought up to date with
+    only the adds/deletes since the generation seen on the previous run.
+    falls back to a full list for servers without the changes command.
+    """
+    state = _load_remote_state(host, port)
+    if state:
+        args = [state["epoch"], str(state["generation"])]
+    else:
+        args = []
+    reply = send_remote_command(host, port, "changes", args)
+
+    if reply[:1] == ["delta"]:
+        files = set(map(lambda f: f.encode("utf-8"), state["files"]))  # json gives unicode
+        for c in reply[3:]:
+            if c[:1] == "+":
+                files.add(c[1:])
+            elif c[:1] == "-":
+                files.discard(c[1:])
+        g_lgr.debug("%d remote changes since generation %s" % (len(reply) - 3, args[1]))
+    elif reply[:1] == ["full"]:
+        files = set(reply[3:])
+        g_lgr.debug("full remote listing at generation %s" % reply[2])
+    else:
+        g_lgr.debug("%s:%d has no changes command, listing all files" % (host, port))
+        return remote_get_files(host, port)
+
+    _save_remote_state(host, port, {
+        "epoch": reply[1],
+        "generation": int(reply[2]),
+        "files": sorted(files),
+    })
+    g_lgr.debug("num remote files %d" % len(files))
+    return list(files)
+
+g_digest_cache = None  # key = file path, value = [size, mtime, md5]
+
+def _file_digest(filename):
+    """
+    md5 of a local file, cached across runs by size and mtime
+    """
+    global g_digest_cache
+    if g_digest_cache is None:
+        try:
+            with open(_digest_cache_filename(), "rb") as fp:
+                g_digest_cache = json.load(fp)
+        except (IOError, ValueError):
+            g_digest_cache = {}
+    st = os.stat(filename)
+    entry = g_digest_cache.get(filename)
+    if entry is None or entry[:2] != [st.st_size, st.st_mtime]:
+        h = hashlib.md5()
+        with open(filename, "rb") as fp:
+            for chunk in iter(lambda: fp.read(65536), ""):
+                h.update(chunk)
+        entry = [st.st_size, st.st_mtime, h.hexdigest()]
+        g_digest_cache[filename] = entry
+    return entry[2]
+
+def _digest_cache_filename():
+    state_path = g_params.get("remote_state_path", tempfile.gettempdir())
+    return os.path.join(state_path, "sync_all_digests.json")
+
+def _save_digest_cache(files):
+    if g_digest_cache is None:
+        return
+    files = set(files)
+    for f in g_digest_cache.keys():
+        if f not in files:
+            del g_digest_cache[f]
+    with open(_digest_cache_filename(), "wb") as fp:
+        json.dump(g_digest_cache, fp)
+
+def remote_sync_files(host, port, files):
+    """
+    make the frame hold exactly the given files in one exchange: the server
+    deletes whatever is not in the manifest and replies with the names it
+    is missing or holds with different content
+    @param [] files local output file paths
+    @return [] local paths to upload, None if the server can't sync
+    """
+    name_file_map = dict(map(lambda f: (os.path.basename(f).lower(), f), files))
+    manifest = []
+    for name, f in sorted(name_file_map.iteritems()):
+        manifest.append([name, str(os.path.getsize(f)), _file_digest(f)])
+    _save_digest_cache(files)
+
+    conn, reused = _acquire_connection(host, port)
+    if conn is None:
+        return None
+
+    t = time.time()
+    for attempt in range(2):
+        try:
+            recv = conn.send_rows(["sync", str(len(manifest))], manifest)
+            break
+        except Exception as ex:
+            conn.close()
+            if attempt or not reused or not isinstance(ex, socket.error):
+                raise
+            conn = remote_connection_t(host, port)  # dropped since the liveness check
+    _release_connection(conn)
+    elapsed = time.time() - t
+    _stat("remote sync", elapsed, len(manifest), sum(map(lambda r: sum(map(len, r)), manifest)))
+    _stat_latency("remote sync", elapsed)
+    g_lgr.debug("Sent:     sync of %d files" % len(manifest))
+    g_lgr.debug("Received: {}".format("\t".join(recv)))
+
+    if not recv or not recv[0].isdigit():
+        return None
+    needed = filter(None, recv[1:])
+    g_lgr.info("num remote files deleted '%s', %d files needed (manifest:%d)" % (recv[0], len(needed), len(manifest)))
+    return map(lambda n: name_file_map[n], needed)
+
+def remote_get_files_meta(host, port):
+    """
+    @return {} key = remote file name, value = (size, mtime, md5),
+            None if the server doesn't have list meta
+    """
+    fields = send_remote_command(host, port, "list", ["meta"])
+    if fields[:1] != ["meta"]:
+        return None
+    files = {}
+    for i in range(1, len(fields) - 3, 4):
+        files[fields[i]] = (int(fields[i + 1]), float(fields[i + 2]), fields[i + 3])
+    g_lgr.debug("num remote files %d" % len(files))
+    return files
+
+def remote_diff_files(host, port, files):
+    """
+    for frames without the sync command: diff by name, and where the
+    server has list meta, also by content so a re-rendered file that kept
+    its name is uploaded again
+    @param [] files local output file paths
+    @return ([] local paths to upload, [] remote names to delete)
+    """
+    local_files = dict(map(lambda f: (os.path.basename(f).lower(), f), files))
+    remote_meta = remote_get_files_meta(host, port)
+    if remote_meta is None:
+        remote_files = set(remote_get_files_since(host, port))
+        changed = set()
+    else:
+        remote_files = set(remote_meta)
+        changed = set()
+        for name in remote_files & set(local_files):
+            f = local_files[name]
+            size, mtime, digest = remote_meta[name]
+            if os.path.getsize(f) != size or _file_digest(f) != digest:
+                changed.add(name)
+        _save_digest_cache(files)
+        if changed: g_lgr.info("%d files differ in content on %s" % (len(changed), host))
+
+    upload_names = (set(local_files) - remote_files) | changed
+    return map(lambda n: local_files[n], sorted(upload_names)), sorted(remote_files - set(local_files))
+
 def remote_delete_files(host, port, files):
-    recv = send_remote_command(host, port, "del", files).strip()
+    recv = "".join(send_remote_command(host, port, "del", files)[:1])
     for f in files:
         g_lgr.info("deleted %s" % f)
     g_lgr.info("num remote files deleted '%s' (requested:%d)" % (recv, len(files)))